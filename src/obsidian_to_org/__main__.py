@@ -1,161 +1,228 @@
 #!/usr/bin/env python3
 
 import argparse
+import atexit
+import functools
+import json
+import os
 import pathlib
+import queue
 import re
+import socket
 import subprocess
-import tempfile
-import uuid
+import threading
+import time
+import urllib.error
+import urllib.request
 import shutil
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+try:
+    # google-re2 scans in linear time, which helps on large vaults.
+    import re2  # type: ignore[import-not-found]
+except ImportError:
+    re2 = None
+
+from ._fixups import (  # noqa: F401
+    COMMENT_MARKER,
+    fix_links,
+    fix_markdown_code_blocks,
+    fix_markdown_comments,
+    get_keys,
+    maybeSplitList,
+    prepare_markdown_text,
+    restore_comments,
+)
 
 
-COMMENT_MARKER = "#!#comment:"
 RULER_RE = re.compile(r"^---\n(.+)", re.MULTILINE)
-LINK_RE = re.compile(r"\[\[([^|\[\.]*?)\]\]")
-LINK_DESCRIPTION_RE = re.compile(r"\[\[([^\.]*?)\|(.*?)\]\]")
-# E.g., ![[myimage.png]]
-IMAGE_RE = re.compile(r"!?\[\[(?:[^|\[\]\.]*/)?([^/\]]+\.(png|jpe?g|svg|gif))\]\]")
-PDF_RE = re.compile(r"!?\[\[(?:[^|\[\]\.]*/)?([^/\]]+\.(pdf|PDF))\]\]")
 
 # See https://help.obsidian.md/How+to/Working+with+tags#Allowed+characters
-TAGS_RE = re.compile(r"#([A-Za-z][A-Za-z0-9/_-]*)")
+TAGS_RE = (re2 or re).compile(r"#([A-Za-z][A-Za-z0-9/_-]*)")
 
 # For example, [[file:foo.org][The Title is Foo]]
 FILE_LINK_RE = re.compile(r"\[\[file:(.*?)\]\[(.*?)\]\]")
 
 
-def fix_markdown_code_blocks(markdown_contents):
-    """Convert special Obsidian code blocks."""
-    # Replace blocks of the form run-<language> from Execute Code plugin
-    # with normal <language> blocks
-    markdown_contents = re.sub(r"```run-(.*)", r"```\1", markdown_contents)
-    # Convert sh to shell blocks
-    markdown_contents = markdown_contents.replace("```sh", "```shell")
-
-    return markdown_contents
-
-
-def fix_markdown_comments(markdown_contents):
-    """Turn Obsidian comments into HTML comments."""
-    chunks = markdown_contents.split("%%")
-    inside_comment = False
-    output = []
-    for i, chunk in enumerate(chunks):
-        if not inside_comment:
-            output.append(chunk)
-            inside_comment = True
-        else:
-            if "\n" in chunk:
-                lines = chunk.splitlines(True)
-                if len(lines) > 0 and lines[0].strip() == "":
-                    lines = lines[1:]
-                output.extend(f"{COMMENT_MARKER}{line}" for line in lines)
-            else:
-                output.extend(["<!--", chunk, "-->"])
-            inside_comment = False
-    return "".join(output)
-
-
-def restore_comments(org_contents):
-    """Restore the comments in org format."""
-    return "".join(
-        line.replace(COMMENT_MARKER, "# ") for line in org_contents.splitlines(True)
-    )
-
-
-def prepare_markdown_text(markdown_contents):
-    markdown_contents = fix_markdown_comments(markdown_contents)
-    markdown_contents = fix_markdown_code_blocks(markdown_contents)
-    return markdown_contents
-
-
-def fix_links(org_contents):
-    """Convert all kinds of links."""
-    org_contents = LINK_RE.sub(r"[[file:\1.org][\1]]", org_contents)
-    org_contents = LINK_DESCRIPTION_RE.sub(r"[[file:\1.org][\2]]", org_contents)
-    # I have org-roam-images set in org-link-abbrev-alist to point to where
-    # all org roam images are stored. Similar for pdfs.
-    org_contents = IMAGE_RE.sub(r"[[org-roam-images:\1]]", org_contents)
-    org_contents = PDF_RE.sub(r"[[org-roam-attachments:\1]]", org_contents)
-    org_contents = org_contents.replace("%20", " ")
-    return org_contents
+@functools.lru_cache(maxsize=4096)
+def file_stem(file_name):
+    """Return the stem of file_name, caching it as links repeat across notes."""
+    return pathlib.PurePath(file_name).stem
 
 
 def convert_file_links_to_id_links(org_contents, nodes):
+    """Replace file links to known nodes with org-roam ID links."""
+    if "[[file:" not in org_contents:
+        return org_contents
+
     def replace_with_id(match):
         file_name = match.group(1).replace("%20", " ")  # Handle spaces in filenames
-        node_id = nodes.get(pathlib.Path(file_name).stem)
+        node_id = nodes.get(file_stem(file_name))
         if not node_id:
             return match.group(0)
         return f"[[id:{node_id}][{match.group(2)}]]"
 
+    return FILE_LINK_RE.sub(replace_with_id, org_contents)
 
-def convert_markdown_file(md_file, org_file):
-    markdown_contents = prepare_markdown_text(md_file.read_text())
 
-    # Convert from md to org
-    with tempfile.NamedTemporaryFile("w+") as fp:
-        fp.write(markdown_contents)
-        fp.flush()
-        subprocess.run(
+PANDOC_FROM = "markdown-tex_math_dollars-auto_identifiers"
+PANDOC_TO = "org"
+PANDOC_WRAP = "preserve"
+
+
+def run_pandoc(markdown_contents):
+    """Convert Markdown to org with a fresh pandoc process."""
+    result = subprocess.run(
+        [
+            "pandoc",
+            f"--from={PANDOC_FROM}",
+            f"--to={PANDOC_TO}",
+            f"--wrap={PANDOC_WRAP}",
+        ],
+        # pandoc always speaks UTF-8, whatever the locale says.
+        input=markdown_contents.encode("utf-8"),
+        stdout=subprocess.PIPE,
+        check=True,
+    )
+    return result.stdout.decode("utf-8")
+
+
+class PandocServer:
+    """A single `pandoc server` process that converts Markdown to org.
+
+    Starting pandoc is much slower than converting a typical note, so
+    converting a whole vault through one server avoids paying that cost for
+    every file. Needs pandoc 3.0 or later.
+    """
+
+    def __init__(self, startup_timeout=10, conversion_timeout=300):
+        # Ask the OS for a free port; pandoc server cannot pick one itself.
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}/"
+        # pandoc server aborts conversions that exceed its --timeout, which
+        # defaults to a couple of seconds; large notes need longer, especially
+        # with every worker thread sharing the one server.
+        self.conversion_timeout = conversion_timeout
+        self._process = subprocess.Popen(
             [
                 "pandoc",
-                "--from=markdown-tex_math_dollars-auto_identifiers",
-                "--to=org",
-                "--wrap=preserve",
-                "--output",
-                org_file,
-                fp.name,
+                "server",
+                f"--port={port}",
+                f"--timeout={conversion_timeout}",
             ],
-            check=True,
+            # The server announces its port on stderr; conversion errors come
+            # back in the HTTP response instead.
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
         )
+        deadline = time.monotonic() + startup_timeout
+        while True:
+            if self._process.poll() is not None:
+                raise RuntimeError(
+                    f"pandoc server exited with status {self._process.returncode}"
+                )
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    self.close()
+                    raise
+                time.sleep(0.05)
+
+    def convert(self, markdown_contents):
+        """Convert Markdown to org, like run_pandoc."""
+        request = urllib.request.Request(
+            self.url,
+            data=json.dumps(
+                {
+                    "text": markdown_contents,
+                    "from": PANDOC_FROM,
+                    "to": PANDOC_TO,
+                    "wrap": PANDOC_WRAP,
+                }
+            ).encode("utf-8"),
+            headers={
+                "Content-Type": "application/json",
+                "Accept": "application/json",
+            },
+        )
+        try:
+            # Allow for the server's own timeout before giving up on it.
+            with urllib.request.urlopen(
+                request, timeout=self.conversion_timeout + 30
+            ) as response:
+                result = json.load(response)
+        except urllib.error.HTTPError as e:
+            # Failed conversions come back as an error status with pandoc's
+            # message as the body.
+            message = e.read().decode("utf-8", errors="replace").strip()
+            raise RuntimeError(
+                f"pandoc server failed with HTTP {e.code}: {message}"
+            ) from e
+        if "error" in result:
+            raise RuntimeError(f"pandoc server failed: {result['error']}")
+        return result["output"]
+
+    def close(self):
+        self._process.terminate()
+        self._process.wait()
+
+
+def markdown_to_org(markdown_text, pandoc=run_pandoc):
+    """Convert Obsidian Markdown text to org text."""
+    markdown_contents = prepare_markdown_text(markdown_text)
 
-    org_contents = org_file.read_text()
+    # Convert from md to org
+    org_contents = pandoc(markdown_contents)
     org_contents = restore_comments(org_contents)
     org_contents = fix_links(org_contents)
-    org_file.write_text(org_contents)
+    return org_contents
+
+
+def convert_markdown_file(md_file, org_file):
+    markdown_text = md_file.read_text(encoding="utf-8")
+    org_file.write_text(markdown_to_org(markdown_text), encoding="utf-8")
 
 
 def walk_directory(path):
-    # From https://stackoverflow.com/questions/6639394/what-is-the-python-way-to-walk-a-directory-tree
-    for p in path.iterdir():
-        if p.is_dir():
-            yield from walk_directory(p)
-            continue
-        yield p.resolve()
-
-
-def maybeSplitList(s):
-    """If the string s represents a list, create a list. Otherwise return as is"""
-    if len(s) > 0 and (s.startswith("[") or "," in s):
-        if s.startswith("["):
-            s = s[1:-1]
-        # Split at whitespace or commas, respecting quotes
-        s = re.findall(r'(?:[^\s,"]|"(?:\\.|[^"])*")+', s)
-        return s
-    return s
-
-
-def get_keys(content):
-    """Return a dictionary of all the YAML keys and values"""
-    lines = content.split("\n")
-    frontmatter = defaultdict(lambda: "")
-    if not lines or lines[0] != "---":
-        return frontmatter
-    for i in range(1, len(lines)):
-        if lines[i] == "---\n":
-            break
-        key = lines[i].split(":")[0]
-        val = ":".join(lines[i].split(":")[1:]).strip()
-        if not val:
-            continue
-        if key != "title":
-            val = maybeSplitList(val)
-        if key in ["tags", "aliases"] and not isinstance(val, list):
-            val = [val]  # always use a list for tags / aliases
-        frontmatter[key] = val
-    return frontmatter
+    """Yield every file below path.
+
+    Paths are built on top of path rather than resolved, so callers that need
+    absolute paths should pass an absolute (resolved) directory.
+    """
+    stack = [path]
+    while stack:
+        directory = stack.pop()
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                # is_dir() uses the file type from the directory listing, so
+                # this needs no extra stat except for symlinks.
+                if entry.is_dir():
+                    stack.append(entry.path)
+                else:
+                    yield pathlib.Path(entry.path)
+
+
+def copy_if_changed(source, destination):
+    """Copy source to destination unless it already holds the same file.
+
+    Files count as the same if size and modification time match, which
+    shutil.copy2 preserves. Returns whether the file was copied.
+    """
+    if destination.exists():
+        source_stat = source.stat()
+        destination_stat = destination.stat()
+        if (source_stat.st_size, source_stat.st_mtime_ns) == (
+            destination_stat.st_size,
+            destination_stat.st_mtime_ns,
+        ):
+            return False
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    shutil.copy2(str(source), str(destination))
+    return True
 
 
 def single_file():
@@ -178,8 +245,8 @@ def single_file():
     print(f"Converted {md_file} to {org_file}")
 
 
-def add_node_id(org_file, node_id, frontmatter):
-    contents = org_file.read_text()
+def add_node_id(org_file, node_id, frontmatter, body):
+    """Write body to org_file under an org-roam properties header."""
     basename = org_file.stem
     tags = ":".join(frontmatter["tags"])
     aliases = " ".join(frontmatter["aliases"])
@@ -188,34 +255,60 @@ def add_node_id(org_file, node_id, frontmatter):
         title = frontmatter["title"]
         if title.startswith('"'):
             title = title[1:-1]
-    with org_file.open("w") as fp:
-        fp.write(":PROPERTIES:\n")
-        fp.write(f":ID: {node_id}\n")
 
-        if aliases:
-            fp.write(f":ROAM_ALIASES: {aliases}\n")
+    header = [":PROPERTIES:\n", f":ID: {node_id}\n"]
 
-        if basename.startswith("@"):  # reference notes
-            fp.write(f":ROAM_REFS: [cite:{basename}]\n")
+    if aliases:
+        header.append(f":ROAM_ALIASES: {aliases}\n")
 
-        fp.write(":END:\n")
+    if basename.startswith("@"):  # reference notes
+        header.append(f":ROAM_REFS: [cite:{basename}]\n")
 
-        fp.write(f"#+title: {title}\n")
+    header.append(":END:\n")
 
-        if "date-created" in frontmatter:
-            fp.write(f'#+created: [{frontmatter["date-created"]}]\n')
+    header.append(f"#+title: {title}\n")
 
-        if tags:
-            fp.write(f"#+filetags: :{tags}:\n")
+    if "date-created" in frontmatter:
+        header.append(f'#+created: [{frontmatter["date-created"]}]\n')
 
-        fp.write("\n\n")
-        fp.write(contents)
+    if tags:
+        header.append(f"#+filetags: :{tags}:\n")
+
+    header.append("\n\n")
+    org_file.write_text("".join(header) + body, encoding="utf-8")
 
 
 def find_tags_in_markdown(contents):
     return TAGS_RE.findall(contents)
 
 
+def generate_node_ids(batch_size=1024):
+    """Yield upper-case random (version 4) UUIDs to use as org-roam IDs."""
+    while True:
+        # Draw randomness for a whole batch at once and format it directly,
+        # rather than building a uuid.UUID for every note.
+        random_bytes = bytearray(os.urandom(16 * batch_size))
+        random_bytes[6::16] = bytes(b & 0x0F | 0x40 for b in random_bytes[6::16])
+        random_bytes[8::16] = bytes(b & 0x3F | 0x80 for b in random_bytes[8::16])
+        digits = random_bytes.hex().upper()
+        for i in range(0, len(digits), 32):
+            h = digits[i : i + 32]
+            yield f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}"
+
+
+def _convert_one(path, node_id, markdown_directory, output_directory, pandoc):
+    """Convert a single Markdown file, returning its org stem and node ID."""
+    org_filename = path.relative_to(markdown_directory).with_suffix(".org")
+    org_path = output_directory / org_filename
+    org_path.parent.mkdir(parents=True, exist_ok=True)
+    markdown_text = path.read_text(encoding="utf-8")
+    org_contents = markdown_to_org(markdown_text, pandoc)
+    frontmatter = get_keys(markdown_text)
+    add_node_id(org_path, node_id, frontmatter, org_contents)
+    print(f"Converted {path} to {org_filename}")
+    return org_filename.stem, node_id
+
+
 def convert_directory():
     parser = argparse.ArgumentParser(
         description="Convert a directory of Obsidian markdown files into org-mode"
@@ -248,51 +341,112 @@ def convert_directory():
         help="path to output linked pdf files",
         default=None,
     )
+    parser.add_argument(
+        "--pandoc_server",
+        action="store_true",
+        help="convert through one long-running pandoc server (pandoc 3.0+)",
+    )
     args = parser.parse_args()
 
     markdown_directory = args.markdown_directory.resolve()
-    skip_dirs = re.compile(args.skip_dirs)
+    # An empty pattern would match (and so skip) every path.
+    skip_dirs = re.compile(args.skip_dirs) if args.skip_dirs else None
     image_dir = args.image_dir
     pdf_dir = args.pdf_dir
 
     if not args.output_directory.is_dir():
         args.output_directory.mkdir()
 
+    pandoc = run_pandoc
+    if args.pandoc_server:
+        server = PandocServer()
+        atexit.register(server.close)
+        pandoc = server.convert
+
+    # Markdown files are queued as soon as the walk finds them, so walking the
+    # vault overlaps with conversion. Conversions mostly wait on pandoc, so
+    # threads are not held back by the GIL.
+    markdown_paths = queue.Queue()
+    # Set on the first failure (or Ctrl-C) so the remaining queued notes are
+    # skipped instead of converted.
+    stop = threading.Event()
+
+    def convert_queued():
+        converted = {}
+        while (item := markdown_paths.get()) is not None:
+            if stop.is_set():
+                continue
+            try:
+                stem, node_id = _convert_one(
+                    *item, markdown_directory, args.output_directory, pandoc
+                )
+            except BaseException:
+                stop.set()
+                raise
+            converted[stem] = node_id
+        return converted
+
+    workers = os.cpu_count() or 1
     nodes = {}
-
-    for path in walk_directory(markdown_directory):
-        if path.name == ".DS_Store" or re.search(skip_dirs, str(path)):
-            continue
-
-        if path.suffix != ".md":
-            if path.suffix in [".png", ".jpg", ".jpeg", ".svg", ".gif"] and image_dir:
-                copy_path = (
-                    image_dir / path.name
-                )  # args.output_directory / os.path.join("images", path.name)
-            elif path.suffix in [".pdf", ".PDF"] and pdf_dir:
-                copy_path = pdf_dir / path.name
-            else:
-                copy_to = path.relative_to(markdown_directory)
-                copy_path = args.output_directory / copy_to
-            print(f"Copying from {path} to {copy_path}")
-            copy_path.parent.mkdir(parents=True, exist_ok=True)
-            shutil.copy(str(path), str(copy_path))
-            continue
-        org_filename = path.relative_to(markdown_directory).with_suffix(".org")
-        org_path = args.output_directory / org_filename
-        org_path.parent.mkdir(parents=True, exist_ok=True)
-        convert_markdown_file(path, org_path)
-        frontmatter = get_keys(path.read_text())
-        nodes[org_filename.stem] = node_id = str(uuid.uuid4()).upper()
-        add_node_id(org_path, node_id, frontmatter)
-        print(f"Converted {path} to {org_filename}")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        consumers = [executor.submit(convert_queued) for _ in range(workers)]
+        node_ids = generate_node_ids()
+        try:
+            for path in walk_directory(markdown_directory):
+                if stop.is_set():
+                    break
+                if path.name == ".DS_Store" or (
+                    skip_dirs and skip_dirs.search(str(path))
+                ):
+                    continue
+
+                if path.suffix != ".md":
+                    if (
+                        path.suffix in [".png", ".jpg", ".jpeg", ".svg", ".gif"]
+                        and image_dir
+                    ):
+                        copy_path = (
+                            image_dir / path.name
+                        )  # args.output_directory / os.path.join("images", path.name)
+                    elif path.suffix in [".pdf", ".PDF"] and pdf_dir:
+                        copy_path = pdf_dir / path.name
+                    else:
+                        copy_to = path.relative_to(markdown_directory)
+                        copy_path = args.output_directory / copy_to
+                    if copy_if_changed(path, copy_path):
+                        print(f"Copied {path} to {copy_path}")
+                    continue
+                markdown_paths.put((path, next(node_ids)))
+        except BaseException:
+            stop.set()
+            raise
+        finally:
+            for _ in consumers:
+                markdown_paths.put(None)
+        try:
+            for consumer in as_completed(consumers):
+                nodes.update(consumer.result())
+        except BaseException:
+            stop.set()
+            raise
+
+    # With no converted notes there are no ID links to point at.
+    if not nodes:
+        return
 
     for org_path in walk_directory(args.output_directory):
         if org_path.name == ".DS_Store" or org_path.suffix != ".org":
             continue
 
-        contents = org_path.read_text()
-        org_path.write_text(convert_file_links_to_id_links(contents, nodes))
+        # Only decode the files that have links to rewrite.
+        raw_contents = org_path.read_bytes()
+        if b"[[file:" not in raw_contents:
+            continue
+        contents = raw_contents.decode("utf-8")
+        new_contents = convert_file_links_to_id_links(contents, nodes)
+        if new_contents == contents:
+            continue
+        org_path.write_text(new_contents, encoding="utf-8")
         print(f"Converted links in {org_path}")
 
     # TODO: What about tags (e.g. #literature). See https://www.orgroam.com/manual.html#Tags
@@ -0,0 +1,133 @@
+"""Text fixups applied around the pandoc conversion.
+
+These are pure string functions with type annotations, so the module can be
+compiled with mypyc, run from the ``src`` directory::
+
+    cd src && mypyc obsidian_to_org/_fixups.py
+"""
+
+import re
+from collections import defaultdict
+from typing import Union
+
+
+COMMENT_MARKER = "#!#comment:"
+
+# All Obsidian link forms, matched in a single pass. The alternatives are
+# tried in order, so plain links win over links with a description.
+LINKS_RE = re.compile(
+    # E.g., [[My Note]]
+    r"\[\[(?P<link>[^|\[\.]*?)\]\]"
+    # E.g., [[My Note|description]]
+    r"|\[\[(?P<target>[^\.\[\]]*?)\|(?P<description>.*?)\]\]"
+    # E.g., ![[myimage.png]] or ![[attachments/paper.pdf]]
+    r"|!?\[\[(?:[^|\[\]\.]*/)?"
+    r"(?P<attachment>[^/\]|]+\.(?P<extension>png|jpe?g|svg|gif|pdf|PDF))\]\]"
+)
+
+# The YAML block between the leading pair of --- lines
+FRONTMATTER_RE = re.compile(r"\A---\n(.*?)^---$", re.MULTILINE | re.DOTALL)
+
+# Items of a YAML list value, split at whitespace or commas, respecting quotes
+LIST_ITEM_RE = re.compile(r'(?:[^\s,"]|"(?:\\.|[^"])*")+')
+
+# Execute Code plugin blocks, e.g. ```run-python
+RUN_BLOCK_RE = re.compile(r"```run-(.*)")
+
+FrontmatterValue = Union[str, list[str]]
+
+
+def fix_markdown_code_blocks(markdown_contents: str) -> str:
+    """Convert special Obsidian code blocks."""
+    # Replace blocks of the form run-<language> from Execute Code plugin
+    # with normal <language> blocks
+    markdown_contents = RUN_BLOCK_RE.sub(r"```\1", markdown_contents)
+    # Convert sh to shell blocks
+    markdown_contents = markdown_contents.replace("```sh", "```shell")
+
+    return markdown_contents
+
+
+def fix_markdown_comments(markdown_contents: str) -> str:
+    """Turn Obsidian comments into HTML comments."""
+    output: list[str] = []
+    inside_comment = False
+    start = 0
+    while True:
+        end = markdown_contents.find("%%", start)
+        if end < 0:
+            end = len(markdown_contents)
+        if not inside_comment:
+            output.append(markdown_contents[start:end])
+        elif markdown_contents.find("\n", start, end) >= 0:
+            lines = markdown_contents[start:end].splitlines(True)
+            if lines[0].strip() == "":
+                del lines[0]
+            output.extend(f"{COMMENT_MARKER}{line}" for line in lines)
+        else:
+            output.extend(["<!--", markdown_contents[start:end], "-->"])
+        if end == len(markdown_contents):
+            break
+        start = end + 2
+        inside_comment = not inside_comment
+    return "".join(output)
+
+
+def restore_comments(org_contents: str) -> str:
+    """Restore the comments in org format."""
+    return org_contents.replace(COMMENT_MARKER, "# ")
+
+
+def prepare_markdown_text(markdown_contents: str) -> str:
+    markdown_contents = fix_markdown_comments(markdown_contents)
+    markdown_contents = fix_markdown_code_blocks(markdown_contents)
+    return markdown_contents
+
+
+def _replace_link(match: re.Match[str]) -> str:
+    kind = match.lastgroup
+    if kind == "link":
+        return f"[[file:{match['link']}.org][{match['link']}]]"
+    if kind == "description":
+        return f"[[file:{match['target']}.org][{match['description']}]]"
+    # I have org-roam-images set in org-link-abbrev-alist to point to where
+    # all org roam images are stored. Similar for pdfs.
+    if match["extension"].lower() == "pdf":
+        return f"[[org-roam-attachments:{match['attachment']}]]"
+    return f"[[org-roam-images:{match['attachment']}]]"
+
+
+def fix_links(org_contents: str) -> str:
+    """Convert all kinds of links."""
+    org_contents = LINKS_RE.sub(_replace_link, org_contents)
+    org_contents = org_contents.replace("%20", " ")
+    return org_contents
+
+
+def maybeSplitList(s: str) -> FrontmatterValue:
+    """If the string s represents a list, create a list. Otherwise return as is"""
+    if len(s) > 0 and (s.startswith("[") or "," in s):
+        if s.startswith("["):
+            s = s[1:-1]
+        return LIST_ITEM_RE.findall(s)
+    return s
+
+
+def get_keys(content: str) -> defaultdict[str, FrontmatterValue]:
+    """Return a dictionary of all the YAML keys and values"""
+    frontmatter: defaultdict[str, FrontmatterValue] = defaultdict(lambda: "")
+    match = FRONTMATTER_RE.match(content)
+    if not match:
+        return frontmatter
+    for line in match.group(1).splitlines():
+        key, _, raw_val = line.partition(":")
+        raw_val = raw_val.strip()
+        if not raw_val:
+            continue
+        val: FrontmatterValue = raw_val
+        if key != "title":
+            val = maybeSplitList(raw_val)
+        if key in ["tags", "aliases"] and not isinstance(val, list):
+            val = [val]  # always use a list for tags / aliases
+        frontmatter[key] = val
+    return frontmatter
@@ -1,6 +1,13 @@
 """Tests for obsidian-to-org."""
 
+import itertools
+import re
+import shutil
+import subprocess
 import tempfile
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, HTTPServer
 from pathlib import Path
 from textwrap import dedent
 
@@ -11,12 +18,24 @@ from collections import defaultdict
 
 sys.path.append(os.path.abspath("src"))
 
+import obsidian_to_org.__main__ as obsidian_to_org_main
 from obsidian_to_org.__main__ import (
+    PandocServer,
+    add_node_id,
+    convert_directory,
+    convert_file_links_to_id_links,
     convert_markdown_file,
+    copy_if_changed,
     fix_links,
     fix_markdown_comments,
     fix_markdown_code_blocks,
+    find_tags_in_markdown,
+    generate_node_ids,
     get_keys,
+    markdown_to_org,
+    restore_comments,
+    run_pandoc,
+    walk_directory,
 )
 
 
@@ -67,6 +86,203 @@ def test_convert_markdown_file():
     assert org == expected
 
 
+def test_walk_directory(tmp_path):
+    (tmp_path / "a" / "b").mkdir(parents=True)
+    (tmp_path / "empty").mkdir()
+    for name in ["top.md", "a/middle.md", "a/b/deep.md", "a/b/image.png"]:
+        (tmp_path / name).write_text("")
+
+    paths = list(walk_directory(tmp_path))
+
+    assert {path.relative_to(tmp_path) for path in paths} == {
+        Path("top.md"),
+        Path("a/middle.md"),
+        Path("a/b/deep.md"),
+        Path("a/b/image.png"),
+    }
+    assert len(paths) == 4
+
+
+def test_add_node_id(tmp_path):
+    org_file = tmp_path / "note.org"
+    frontmatter = get_keys(
+        dedent(
+            """\
+            ---
+            title: "A Note"
+            aliases: [one, two]
+            tags: [t1, t2]
+            date-created: 2022-09-05
+            ---
+            """
+        )
+    )
+    add_node_id(org_file, "NODE-ID", frontmatter, "Body text.\n")
+    assert org_file.read_text() == dedent(
+        """\
+        :PROPERTIES:
+        :ID: NODE-ID
+        :ROAM_ALIASES: one two
+        :END:
+        #+title: A Note
+        #+created: [2022-09-05]
+        #+filetags: :t1:t2:
+
+
+        Body text.
+        """
+    )
+
+
+def test_add_node_id_reference_note(tmp_path):
+    org_file = tmp_path / "@smith2020.org"
+    frontmatter = get_keys("---\ntitle: Ignored\n---\n")
+    add_node_id(org_file, "NODE-ID", frontmatter, "Body text.\n")
+    assert org_file.read_text() == dedent(
+        """\
+        :PROPERTIES:
+        :ID: NODE-ID
+        :ROAM_REFS: [cite:@smith2020]
+        :END:
+        #+title: @smith2020
+
+
+        Body text.
+        """
+    )
+
+
+def pandoc_major_version():
+    """Return the installed pandoc's major version, or None without pandoc."""
+    if not shutil.which("pandoc"):
+        return None
+    output = subprocess.run(
+        ["pandoc", "--version"], stdout=subprocess.PIPE, text=True, check=True
+    ).stdout
+    return int(output.split()[1].split(".")[0])
+
+
+def test_markdown_to_org_with_custom_pandoc():
+    seen = []
+
+    def fake_pandoc(markdown_contents):
+        seen.append(markdown_contents)
+        return "#!#comment:block\n[[Note]] ![[image.png]]\n"
+
+    org = markdown_to_org("%%inline%%\n```run-python\n```\n", pandoc=fake_pandoc)
+
+    # Obsidian syntax is fixed up before pandoc, and comments and links after.
+    assert seen == ["<!--inline-->\n```python\n```\n"]
+    assert org == "# block\n[[file:Note.org][Note]] [[org-roam-images:image.png]]\n"
+
+
+def test_pandoc_server_reports_http_errors():
+    class FailingHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers["Content-Length"]))
+            body = b"Unknown reader: nonsense"
+            self.send_response(500)
+            self.send_header("Content-Type", "text/plain")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    with HTTPServer(("127.0.0.1", 0), FailingHandler) as http_server:
+        thread = threading.Thread(target=http_server.handle_request)
+        thread.start()
+        # Point a server object at the stand-in without starting pandoc.
+        server = PandocServer.__new__(PandocServer)
+        server.url = f"http://127.0.0.1:{http_server.server_port}/"
+        server.conversion_timeout = 5
+        with pytest.raises(RuntimeError, match="HTTP 500: Unknown reader: nonsense"):
+            server.convert("# Title\n")
+        thread.join()
+
+
+@pytest.mark.skipif(
+    (pandoc_major_version() or 0) < 3, reason="pandoc server needs pandoc 3.0+"
+)
+def test_pandoc_server_matches_pandoc():
+    markdown = "# Title\n\nSome *emphasis* and a [link](http://example.com).\n"
+    server = PandocServer()
+    try:
+        assert server.convert(markdown) == run_pandoc(markdown)
+    finally:
+        server.close()
+
+
+def run_convert_directory(monkeypatch, markdown_dir, output_dir, pandoc):
+    """Run convert_directory on markdown_dir with pandoc faked out."""
+    monkeypatch.setattr(obsidian_to_org_main, "run_pandoc", pandoc)
+    monkeypatch.setattr(obsidian_to_org_main.os, "cpu_count", lambda: 4)
+    monkeypatch.setattr(
+        sys, "argv", ["obsidian-to-org-roam", str(markdown_dir), str(output_dir)]
+    )
+    convert_directory()
+
+
+def test_convert_directory(tmp_path, monkeypatch):
+    markdown_dir = tmp_path / "vault"
+    (markdown_dir / "sub").mkdir(parents=True)
+    (markdown_dir / "a.md").write_text("---\ntags: [t1]\n---\nSee [[b]].\n")
+    (markdown_dir / "sub" / "b.md").write_text("Back to [[a]].\n")
+    (markdown_dir / "image.png").write_bytes(b"image")
+    output_dir = tmp_path / "out"
+
+    # The Obsidian links survive an identity "pandoc" unchanged.
+    run_convert_directory(monkeypatch, markdown_dir, output_dir, lambda text: text)
+
+    a_org = (output_dir / "a.org").read_text()
+    b_org = (output_dir / "sub" / "b.org").read_text()
+    a_id = a_org.split(":ID: ")[1].split("\n")[0]
+    b_id = b_org.split(":ID: ")[1].split("\n")[0]
+    assert "#+filetags: :t1:\n" in a_org
+    assert f"See [[id:{b_id}][b]]." in a_org
+    assert f"Back to [[id:{a_id}][a]]." in b_org
+    assert (output_dir / "image.png").read_bytes() == b"image"
+
+
+def test_convert_directory_stops_on_first_failure(tmp_path, monkeypatch):
+    markdown_dir = tmp_path / "vault"
+    markdown_dir.mkdir()
+    for i in range(41):
+        (markdown_dir / f"note{i}.md").write_text(f"Note {i}\n")
+    calls = []
+    lock = threading.Lock()
+
+    def failing_pandoc(text):
+        with lock:
+            calls.append(text)
+            if len(calls) == 3:
+                raise subprocess.CalledProcessError(1, "pandoc")
+        return text
+
+    with pytest.raises(subprocess.CalledProcessError):
+        run_convert_directory(
+            monkeypatch, markdown_dir, tmp_path / "out", failing_pandoc
+        )
+    # Besides the failing call, at most one more note per worker may already
+    # have been in progress.
+    assert len(calls) <= 3 + 4
+
+
+def test_copy_if_changed(tmp_path):
+    source = tmp_path / "image.png"
+    source.write_bytes(b"image")
+    destination = tmp_path / "out" / "image.png"
+
+    assert copy_if_changed(source, destination)
+    assert destination.read_bytes() == b"image"
+    assert not copy_if_changed(source, destination)
+
+    source.write_bytes(b"new image")
+    assert copy_if_changed(source, destination)
+    assert destination.read_bytes() == b"new image"
+
+
 @pytest.mark.parametrize(
     "input_text,expected",
     [
@@ -95,6 +311,23 @@ def test_fix_markown_comments(input_text, expected):
     assert expected == fix_markdown_comments(input_text)
 
 
+@pytest.mark.parametrize(
+    "input_text,expected",
+    [
+        ("foo", "foo"),
+        ("#!#comment:a comment\n", "# a comment\n"),
+        (
+            "#!#comment:multiline\n#!#comment:comment\ntext\n",
+            "# multiline\n# comment\ntext\n",
+        ),
+        # Markers are replaced wherever they appear, not only at line starts.
+        ("text #!#comment:inline", "text # inline"),
+    ],
+)
+def test_restore_comments(input_text, expected):
+    assert expected == restore_comments(input_text)
+
+
 @pytest.mark.parametrize(
     "input_text,expected",
     [
@@ -116,6 +349,21 @@ def test_fix_markown_comments(input_text, expected):
             "[[attachments/example.png]]",
             "[[org-roam-images:example.png]]",
         ),
+        (
+            "![[attachments/example.pdf]]",
+            "[[org-roam-attachments:example.pdf]]",
+        ),
+        (
+            "[[foo]] and [[bar|baz]]",
+            "[[file:foo.org][foo]] and [[file:bar.org][baz]]",
+        ),
+        (
+            "![[note|diagram.png]]",
+            "![[file:note.org][diagram.png]]",
+        ),
+        # Links are converted in one pass, so an unterminated description
+        # swallows a link that follows it instead of containing its conversion.
+        ("[[| x[[y]]", "[[file:.org][ x[[y]]"),
         (
             dedent(
                 """
@@ -142,6 +390,21 @@ def test_fix_links(input_text, expected):
     assert expected == fix_links(input_text)
 
 
+@pytest.mark.parametrize(
+    "input_text,expected",
+    [
+        ("foo", "foo"),
+        ("[[file:foo.org][Foo]]", "[[id:FOO-ID][Foo]]"),
+        ("[[file:dir/foo.org][Foo]]", "[[id:FOO-ID][Foo]]"),
+        ("[[file:My%20Note.org][Note]]", "[[id:NOTE-ID][Note]]"),
+        ("[[file:unknown.org][Unknown]]", "[[file:unknown.org][Unknown]]"),
+    ],
+)
+def test_convert_file_links_to_id_links(input_text, expected):
+    nodes = {"foo": "FOO-ID", "My Note": "NOTE-ID"}
+    assert expected == convert_file_links_to_id_links(input_text, nodes)
+
+
 @pytest.mark.parametrize(
     "input_text,expected",
     [
@@ -185,6 +448,35 @@ def test_fix_markown_code_blocks(input_text, expected):
     assert expected == fix_markdown_code_blocks(input_text)
 
 
+@pytest.mark.parametrize(
+    "input_text,expected",
+    [
+        ("foo", []),
+        ("#tag", ["tag"]),
+        ("Some #tag and #nested/tag_2-b here", ["tag", "nested/tag_2-b"]),
+        # Tags must start with a letter.
+        ("#1 #_x #a1", ["a1"]),
+        ("# Heading", []),
+    ],
+)
+def test_find_tags_in_markdown(input_text, expected, monkeypatch):
+    # Pin the plain re fallback, whether or not google-re2 is installed.
+    tags_re = re.compile(obsidian_to_org_main.TAGS_RE.pattern)
+    monkeypatch.setattr(obsidian_to_org_main, "TAGS_RE", tags_re)
+    assert expected == find_tags_in_markdown(input_text)
+
+
+def test_generate_node_ids():
+    node_ids = list(itertools.islice(generate_node_ids(batch_size=4), 10))
+    assert len(set(node_ids)) == 10
+    for node_id in node_ids:
+        assert node_id == node_id.upper()
+        parsed = uuid.UUID(node_id)
+        assert str(parsed).upper() == node_id
+        assert parsed.version == 4
+        assert parsed.variant == uuid.RFC_4122
+
+
 @pytest.mark.parametrize(
     "input_text,expected",
     [
@@ -246,6 +538,18 @@ def test_fix_markown_code_blocks(input_text, expected):
                 },
             ),
         ),
+        (
+            dedent(
+                """\
+            ---
+            title: Test Title
+            ---
+
+            Note: not a key.
+            """
+            ),
+            defaultdict(lambda: None, {"title": "Test Title"}),
+        ),
     ],
 )
 def test_get_keys(input_text, expected):